@@ -0,0 +1,74 @@
+"""Measure how much generating simulated messages delays the event loop, generating in the loop's process and in a process pool.
+Usage: python bench_generation_pool.py [words in the chain] [messages] [processes]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from markov import MarkovModel, generate_from_snapshot, save_snapshot, warm_up_worker
+
+TICK = 0.005 #seconds between the lag monitor's wake ups
+
+def synthetic_model(words, successors=50, end_weight=1):
+    """A chain of words with successors next words each, where ending the message is rare, so messages run long"""
+    rows = [(0, 'START', next_id, random.randint(1, 100)) for next_id in random.sample(range(2, words), successors)]
+    rows.append((1, 'END', None, None))
+    for node_id in range(2, words):
+        rows.extend((node_id, f'word{node_id}', next_id, random.randint(1, 100)) for next_id in random.sample(range(2, words), successors))
+        rows.append((node_id, f'word{node_id}', 1, end_weight))
+    return MarkovModel.from_rows(rows, 'START', 'END')
+
+async def monitor_lag(lags, done):
+    """Record how late the loop wakes this task up, until done is set"""
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+async def measure(generate, messages):
+    lags = []
+    done = asyncio.Event()
+    monitor = asyncio.ensure_future(monitor_lag(lags, done))
+    start = time.perf_counter()
+    for _ in range(messages):
+        await generate()
+    elapsed = time.perf_counter() - start
+    done.set()
+    await monitor
+    lags.sort()
+    return elapsed, lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000
+
+def report(name, elapsed, median, p99, worst):
+    print(f'{name:>12}: {elapsed:6.2f}s total, event loop lag median {median:6.2f}ms, p99 {p99:7.2f}ms, worst {worst:7.2f}ms')
+
+async def main(words, messages, processes):
+    random.seed(0)
+    model = synthetic_model(words)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.chain')
+    save_snapshot(model, path)
+    print(f'Chain of {words} words, {len(model.targets)} transitions, {os.path.getsize(path) / 1024:.0f} KB snapshot')
+
+    async def in_process():
+        model.generate()
+        await asyncio.sleep(0) #Like MessagePool.refill, let waiting events in between messages
+    report('in process', *await measure(in_process, messages))
+
+    pool = ProcessPoolExecutor(processes, mp_context=get_context('spawn'))
+    for future in [pool.submit(warm_up_worker) for _ in range(processes)]:
+        future.result()
+    loop = asyncio.get_event_loop()
+    async def in_pool():
+        await loop.run_in_executor(pool, generate_from_snapshot, path, 0)
+    report('pool', *await measure(in_pool, messages))
+    pool.shutdown()
+
+if __name__ == '__main__':
+    words = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    asyncio.run(main(words, messages, processes))
@@ -0,0 +1,49 @@
+"""Compare next-word sampling by walking the successor counts with bisecting their running totals.
+Usage: python bench_markov_sampling.py [samples per node size]
+"""
+import random
+import sys
+import time
+from collections import Counter
+
+from markov import cumulative_counts, weighted_index
+
+def linear_index(counts, total):
+    """The sampling MarkovNode.choose_next_word used to do"""
+    number = random.randint(0, total-1)
+    i = 0
+    while number > 0:
+        number -= counts[i]
+        i += 1
+    return i-1 if i else len(counts)-1 #counts[-1] when number is 0, as the old code's self.probabilities[-1]
+
+def synthetic_counts(successors):
+    """Zipf-like counts, like a chatty member's MESSAGE_START node"""
+    return [max(1, int(1000 / (rank+1))) for rank in range(successors)]
+
+def bench(sample, samples):
+    start = time.perf_counter()
+    for _ in range(samples):
+        sample()
+    return (time.perf_counter() - start) / samples * 1e6
+
+def check_distribution(counts, samples):
+    """Largest difference between the two samplers' observed frequencies, over all successors"""
+    total = sum(counts)
+    cumulative = cumulative_counts(counts)
+    linear = Counter(linear_index(counts, total) for _ in range(samples))
+    bisected = Counter(weighted_index(cumulative) for _ in range(samples))
+    return max(abs(linear[i] - bisected[i]) / samples for i in range(len(counts)))
+
+if __name__ == '__main__':
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(0)
+    print(f'Largest frequency difference over 100 successors: {check_distribution(synthetic_counts(100), 200000):.4f}')
+    print(f'{"successors":>10} {"linear us":>10} {"bisect us":>10}')
+    for successors in (10**2, 10**3, 10**4, 10**5):
+        counts = synthetic_counts(successors)
+        total = sum(counts)
+        cumulative = cumulative_counts(counts)
+        linear = bench(lambda: linear_index(counts, total), samples)
+        bisected = bench(lambda: weighted_index(cumulative), samples)
+        print(f'{successors:>10} {linear:>10.2f} {bisected:>10.2f}')
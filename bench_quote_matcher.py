@@ -0,0 +1,52 @@
+"""Compare quote detection throughput of the QuoteAutomaton against the original nested loop over every script line.
+Usage: python bench_quote_matcher.py [corpus paths, see BEE_CORPORA] [number of messages]
+"""
+import random
+import sys
+import time
+
+from bot_utils import remove_punctuation
+from quote_matcher import QuoteAutomaton, load_corpora
+
+def nested_loop_find(lines, content):
+    message_words = remove_punctuation(content).split()
+    message_triplets = [' '.join(message_words[index:index+3]) for index in range(len(message_words)-2)]
+    for line in lines:
+        line_ignore_punctuation = f' {remove_punctuation(line)} '
+        for triplet in message_triplets:
+            if f' {triplet} ' in line_ignore_punctuation:
+                return line
+    return None
+
+def make_messages(corpora, count):
+    """Mostly ordinary chat, with roughly one message in ten quoting a script"""
+    script_words = [word for corpus in corpora for line in corpus.lines for word in line.words]
+    chat_words = ['lol', 'anyone', 'up', 'for', 'raid', 'tonight', 'brb', 'gg', 'that', 'was', 'wild', 'ok', 'sure', 'idk']
+    messages = []
+    for _ in range(count):
+        words = random.choices(chat_words, k=random.randint(3, 15))
+        if random.random() < 0.1:
+            start = random.randrange(len(script_words) - 5)
+            words[random.randrange(len(words)):0] = script_words[start:start+random.randint(3, 5)]
+        messages.append(' '.join(words))
+    return messages
+
+def bench(name, find, messages):
+    start = time.perf_counter()
+    hits = sum(1 for message in messages if find(message))
+    elapsed = time.perf_counter() - start
+    print(f'{name:>12}: {len(messages)/elapsed:12.0f} messages/s ({hits} hits)')
+
+if __name__ == '__main__':
+    spec = sys.argv[1] if len(sys.argv) > 1 else 'corpora/bee_movie.txt'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(0)
+    corpora = load_corpora(spec)
+    start = time.perf_counter()
+    automaton = QuoteAutomaton(corpora)
+    print(f'Built automaton with {automaton.states} states in {time.perf_counter() - start:.2f}s')
+
+    messages = make_messages(corpora, count)
+    lines = [line.text for corpus in corpora for line in corpus.lines]
+    bench('nested loop', lambda content: nested_loop_find(lines, content), messages)
+    bench('automaton', lambda content: automaton.find(remove_punctuation(content).split()), messages)
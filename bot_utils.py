@@ -1,4 +1,10 @@
+import asyncio
+import os
 import string
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from sqlalchemy import Column, BigInteger, Integer
 from sqlalchemy.ext.declarative import declared_attr
@@ -37,15 +43,169 @@ def typing(func):
 def remove_punctuation(punctuated_string):
     return punctuated_string.translate(str.maketrans('', '', string.punctuation))
 
+class IndexedMember:
+    __slots__ = ('member', 'name')
+
+    def __init__(self, member):
+        self.member = member
+        self.name = member.nick or member.name
+
+class GuildIndex:
+    """A guild's members by id and by the name they show up as, and its roles by id"""
+    __slots__ = ('members', 'names', 'roles')
+
+    def __init__(self, guild):
+        self.members = {}
+        self.names = {}
+        self.roles = {role.id: role for role in guild.roles}
+        for member in guild.members:
+            self.add_member(member)
+
+    def add_member(self, member):
+        self.remove_member(member.id)
+        entry = IndexedMember(member)
+        self.members[member.id] = entry
+        self.names.setdefault(entry.name, {})[member.id] = entry
+
+    def remove_member(self, member_id):
+        entry = self.members.pop(member_id, None)
+        if entry:
+            named = self.names[entry.name]
+            del named[member_id]
+            if not named:
+                del self.names[entry.name]
+
+"""Indexes of the guilds looked up so far, only kept once register_guild_index has hooked up the events that keep them current"""
+guild_indexes = {}
+indexing = False
+
+def get_guild_index(guild):
+    index = guild_indexes.get(guild.id)
+    if index is None:
+        index = guild_indexes[guild.id] = GuildIndex(guild)
+    return index
+
+"""Keep the member and role lookups below indexed, instead of searching the guild each time"""
+def register_guild_index(bot):
+    global indexing
+    indexing = True
+
+    def index_of(guild):
+        return guild_indexes.get(guild.id)
+
+    async def on_ready():
+        guild_indexes.clear() #Anything could have changed while disconnected
+
+    async def on_guild_remove(guild):
+        guild_indexes.pop(guild.id, None)
+
+    async def on_member_join(member):
+        index = index_of(member.guild)
+        if index:
+            index.add_member(member)
+
+    async def on_member_update(before, after):
+        await on_member_join(after)
+
+    async def on_member_remove(member):
+        index = index_of(member.guild)
+        if index:
+            index.remove_member(member.id)
+
+    async def on_user_update(before, after):
+        for index in guild_indexes.values():
+            entry = index.members.get(after.id)
+            if entry:
+                index.add_member(entry.member.guild.get_member(after.id) or entry.member)
+
+    async def on_guild_role_create(role):
+        index = index_of(role.guild)
+        if index:
+            index.roles[role.id] = role
+
+    async def on_guild_role_update(before, after):
+        await on_guild_role_create(after)
+
+    async def on_guild_role_delete(role):
+        index = index_of(role.guild)
+        if index:
+            index.roles.pop(role.id, None)
+
+    for listener in (on_ready, on_guild_remove, on_member_join, on_member_update, on_member_remove, on_user_update,
+                     on_guild_role_create, on_guild_role_update, on_guild_role_delete):
+        bot.add_listener(listener)
+
 def get_user_from_name(name, guild):
+    if indexing:
+        named = get_guild_index(guild).names.get(name)
+        return next(iter(named.values())).member if named else None
     return find(lambda m: m.nick == name if m.nick else m.name == name, guild.members)
 
 def get_user_from_id(user_id, guild):
+    if indexing:
+        entry = get_guild_index(guild).members.get(user_id)
+        return entry.member if entry else None
     return find(lambda m: m.id == user_id, guild.members)
 
 def get_role_from_id(role_id, guild):
+    if indexing:
+        return get_guild_index(guild).roles.get(role_id)
     return find(lambda r: r.id == role_id, guild.roles)
 
+DB_THREADS = int(os.getenv('DB_THREADS', 4))
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+
+@contextmanager
+def session_scope(Session):
+    """Provide a transactional scope around a series of operations."""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def run_in_session(Session, func, *args, **kwargs):
+    """Run func(session, *args, **kwargs) in a transactional scope on the database thread pool, and return its result.
+    Database calls block, so running them here keeps the event loop free to dispatch events.
+    The session is closed when this returns, so func should return plain values rather than database objects.
+    """
+    def work():
+        with session_scope(Session) as session:
+            return func(session, *args, **kwargs)
+    return await asyncio.get_event_loop().run_in_executor(db_executor, work)
+
+class LRUCache:
+    """Holds at most max_size entries, evicting the least recently used. Entries expire ttl seconds after they are stored"""
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return entry[0] if entry else default
+
 class BaseMixin:
     @declared_attr
     def __tablename__(cls):
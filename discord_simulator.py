@@ -2,19 +2,24 @@ import asyncio
 import os
 import subprocess
 import traceback
-from time import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from time import monotonic, time
 from io import BytesIO
 from random import choices, randint, seed
 from shutil import which
 
 import discord
 from discord.ext import commands, tasks
-from sqlalchemy import (BigInteger, Column, ForeignKey, Integer, String,
-                        create_engine)
+from sqlalchemy import (BigInteger, Column, ForeignKey, Index, Integer, String,
+                        bindparam, create_engine, exists)
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import relationship, sessionmaker
 
-from bot_utils import BaseMixin, MemberMixin, get_user_from_name, ignore_bots, get_user_from_id, get_role_from_id
+from bot_utils import BaseMixin, LRUCache, MemberMixin, get_user_from_name, ignore_bots, get_user_from_id, get_role_from_id, register_guild_index, run_in_session, session_scope
+from markov import MarkovModel, generate_from_snapshot, load_snapshot, save_snapshot, warm_up_worker
 
 Base = declarative_base()
 engine = create_engine(os.getenv('SIMULATOR_DB'))
@@ -29,15 +34,38 @@ SIM_TIME_MIN = 5
 SIM_TIME_MAX = 9
 
 SCHEDULE_FREQUENCY = 60 * 60 * 6 #six hours
+SCHEDULE_CONCURRENCY = int(os.getenv('SIMULATOR_SCHEDULE_CONCURRENCY', 10)) #scheduled channels simulated at once
+MODEL_CACHE_SIZE = 200 #members
+TRAINING_FREQUENCY = 10 #seconds
+TRAINING_QUEUE_SIZE = 10000 #messages waiting to be trained on before on_message has to wait
+TRAINING_BATCH_SIZE = 2000 #messages trained on per transaction
+TRAINING_ATTEMPTS = 3 #times a single message is written before it is dropped
+MAX_WORD_LENGTH = 500 #characters kept of a word. Postgres can't index a (member, word) entry over about 2.7 KB, and a character can take 4 bytes
+BACKFILL_BATCH_SIZE = 500 #history messages read per transaction
+POOL_SIZE = SIM_LENGTH_MAX #messages generated ahead of time per guild, enough for a whole simulation
+POOL_REFILL_FREQUENCY = 30 #seconds
+POOL_MAX_DRIFT = 0.1 #a member's pooled messages are thrown away once they have been trained on this fraction more messages
+COMPACTION_FREQUENCY = 60 * 60 * 24 #one day
+COMPACTION_BATCH_SIZE = 500 #words pruned per transaction
+PRUNE_MIN_COUNT = int(os.getenv('SIMULATOR_PRUNE_MIN_COUNT', 1)) #transitions seen fewer times than this are pruned. 1 prunes nothing
+PRUNE_TOP_K = int(os.getenv('SIMULATOR_PRUNE_TOP_K', 0)) #most next words kept per word, not counting the end of the message. 0 keeps them all
+PRUNING = PRUNE_MIN_COUNT > 1 or PRUNE_TOP_K > 0 #Pruning loses what was learned for good, so it only runs when it's been asked for
+TUPLE_ROW_BYTES = 32 #rough storage per probabilitytuple row, for reporting
+NODE_ROW_BYTES = 48 #rough storage per markovnode row, not counting its word
+SNAPSHOT_DIR = os.getenv('SIMULATOR_SNAPSHOTS') #Where members' chains are saved for loading without the database. Unset to turn snapshots off
+GENERATION_PROCESSES = int(os.getenv('SIMULATOR_GENERATION_PROCESSES', 0)) #Worker processes generating messages off the event loop, from snapshots. 0 to generate in the bot's process
 
 seed()
 
 class ProbabilityTuple(BaseMixin, Base):
+    __table_args__ = (Index('ix_probabilitytuple_parent_node_id_node_id', 'parent_node_id', 'node_id', unique=True),
+                      Index('ix_probabilitytuple_node_id', 'node_id'))
     parent_node_id = Column(Integer, ForeignKey('markovnode.id'))
     node_id = Column(Integer)
     count = Column(Integer)
 
 class MarkovNode(MemberMixin, BaseMixin, Base):
+    __table_args__ = (Index('ix_markovnode_sim_member_id_word', 'sim_member_id', 'word', unique=True),)
     word = Column(String)
     count = Column(BigInteger)
     probabilities = relationship('ProbabilityTuple', backref="parent_node", cascade="delete, delete-orphan")
@@ -49,28 +77,6 @@ class MarkovNode(MemberMixin, BaseMixin, Base):
         self.word = word
         self.sim_member = sim_member
 
-    def increase_word_count(self, word, session):
-        self.count += 1
-
-        node = MarkovNode.get_or_create(word, self.sim_member, session)
-        session.flush()
-        node_ids = [pt.node_id for pt in self.probabilities]
-        if node.id in node_ids:
-            i = node_ids.index(node.id)
-            self.probabilities[i].count += 1
-        else:
-            pt = ProbabilityTuple(node_id=node.id, count=1)
-            session.add(pt)
-            self.probabilities.append(pt)
-
-    def choose_next_word(self, session):
-        number = randint(0, self.count-1)
-        i = 0
-        while number > 0:
-            number -= self.probabilities[i].count
-            i += 1
-        return session.query(MarkovNode).filter_by(id=self.probabilities[i-1].node_id).one()
-
     @classmethod
     def get_or_create(cls, word, sim_member, session):
         result = session.query(cls).filter_by(word=word, sim_member=sim_member).one_or_none() or\
@@ -83,6 +89,8 @@ class MarkovNode(MemberMixin, BaseMixin, Base):
         return session.query(cls).filter_by(word=word, sim_member=sim_member).one()
 
 class SimulatedMember(MemberMixin, BaseMixin, Base):
+    __table_args__ = (Index('ix_simulatedmember_guild_id_member_id', 'guild_id', 'member_id', unique=True),)
+
     def __init__(self, member=None, session=None):
         super().__init__(member=member)
         session.add(MarkovNode(self, MESSAGE_START))
@@ -93,7 +101,33 @@ class SimulatedMember(MemberMixin, BaseMixin, Base):
 class Channel(BaseMixin, Base):
     channel_id = Column(Integer)
 
-Base.metadata.create_all(engine)
+class BackfillCheckpoint(BaseMixin, Base):
+    channel_id = Column(BigInteger)
+    last_message_id = Column(BigInteger)
+
+class LiveTrainingStart(BaseMixin, Base):
+    """The first message in a channel that was trained on as it was sent. Backfills stop there, since everything after it has been trained on already"""
+    channel_id = Column(BigInteger)
+    first_message_id = Column(BigInteger)
+
+def set_up_storage():
+    """Create the tables, indexes and snapshot directory. Only the bot's process calls this, not the generation workers that import this module again"""
+    Base.metadata.create_all(engine)
+    if SNAPSHOT_DIR:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    for table in (SimulatedMember.__table__, MarkovNode.__table__, ProbabilityTuple.__table__):
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True) #create_all skips indexes on tables that already exist
+
+def get_live_training_starts(session):
+    return dict(session.query(LiveTrainingStart.channel_id, LiveTrainingStart.first_message_id))
+
+def record_live_training_start(session, channel_id, message_id):
+    if not session.query(LiveTrainingStart.id).filter_by(channel_id=channel_id).scalar():
+        session.add(LiveTrainingStart(channel_id=channel_id, first_message_id=message_id))
+
+"""Each channel's first live trained message id, loaded when the bot starts"""
+live_training_starts = {}
 
 bot = commands.Bot(command_prefix='-sim-', description="I am a horrible, twisted version of your guild. FEAR ME.\nFor suggestions and bug reports, create an issue on my github: https://github.com/caydenreynolds/Discord-bots")
 
@@ -105,48 +139,459 @@ class ScheduledSimsCog(commands.Cog):
     async def schedule_sim(self):
         try:
             await bot.wait_until_ready()
-            session = Session()
             channels=[]
-            for channel in session.query(Channel).all():
-                c = bot.get_channel(channel.channel_id)
+            missing=[]
+            for channel_id in await run_in_session(Session, get_scheduled_channel_ids):
+                c = bot.get_channel(channel_id)
                 if c:
                     channels.append(c)
                 else:
-                    session.delete(channel)
+                    missing.append(channel_id)
+            if missing:
+                await run_in_session(Session, unschedule_channels, missing)
             for channel in channels:
-                await simulate(channel, session)
+                message_pool.watch(channel.guild)
+
+            semaphore = asyncio.Semaphore(SCHEDULE_CONCURRENCY)
+            async def simulate_channel(channel):
+                """Returns how long the channel's simulation took, or None if it failed"""
+                async with semaphore:
+                    start_time = monotonic()
+                    try:
+                        await simulate(channel)
+                    except Exception:
+                        traceback.print_exc()
+                        return None
+                    return monotonic() - start_time
+            start_time = monotonic()
+            durations = await asyncio.gather(*[simulate_channel(channel) for channel in channels])
+            for channel, duration in zip(channels, durations):
+                print(f'Scheduled simulation in {channel.id} ' + (f'took {duration:.0f}s' if duration is not None else 'failed'))
+            print(f'Simulated {sum(duration is not None for duration in durations)} of {len(channels)} scheduled channels in {monotonic() - start_time:.0f}s')
         except Exception:
             traceback.print_exc()
-            session.rollback()
-        else:
-            session.commit()
-        finally:
-            session.close()
 
+class MessagePoolCog(commands.Cog):
+    def __init__(self):
+        self.refill_pools.start()
+
+    @tasks.loop(seconds=POOL_REFILL_FREQUENCY)
+    async def refill_pools(self):
+        try:
+            await bot.wait_until_ready()
+            for guild_id in list(message_pool.pools):
+                guild = bot.get_guild(guild_id)
+                if guild:
+                    await message_pool.refill(guild, refresh=True)
+                else:
+                    message_pool.forget(guild_id)
+        except Exception:
+            traceback.print_exc()
 
-def increment_words(member, message):
-    session = Session()
+class CompactionCog(commands.Cog):
+    def __init__(self):
+        self.compact_chains.start()
+
+    @tasks.loop(seconds=COMPACTION_FREQUENCY)
+    async def compact_chains(self):
+        try:
+            if not compaction_lock.locked():
+                print(format_compaction(await compact()))
+        except Exception:
+            traceback.print_exc()
+
+    @compact_chains.before_loop
+    async def wait_for_first_compaction(self):
+        """The loop would otherwise compact as soon as the bot starts, then again every time it restarts"""
+        await bot.wait_until_ready()
+        await asyncio.sleep(COMPACTION_FREQUENCY)
+
+class TrainingCog(commands.Cog):
+    def __init__(self):
+        self.train.start()
+
+    @tasks.loop(seconds=TRAINING_FREQUENCY)
+    async def train(self):
+        budget = TRAINING_BATCH_SIZE
+        while training_retries and len(training_retries[0][0]) <= budget:
+            batch, attempts = training_retries.popleft()
+            budget -= len(batch)
+            if not await train_batch(batch, attempts):
+                return #Likely to fail again until the next tick
+        batch = take_queued(budget)
+        if batch:
+            await train_batch(batch)
+
+"""Messages waiting to be trained on, as (author, content)"""
+training_queue = asyncio.Queue(maxsize=TRAINING_QUEUE_SIZE)
+
+"""Batches that failed to train, as (messages, failed attempts), taken again before the queue.
+A failing batch is split in half until the message that can't be written is alone, then that message is dropped after TRAINING_ATTEMPTS tries
+"""
+training_retries = deque()
+
+"""Held around every write to the chains. Two writes at once could both create the same member or word"""
+training_lock = asyncio.Lock()
+
+def take_queued(limit=None):
+    batch = []
+    while not training_queue.empty() and (limit is None or len(batch) < limit):
+        batch.append(training_queue.get_nowait())
+    return batch
+
+async def train_batch(batch, attempts=0):
+    """Write a batch to the chains, returning whether it was written"""
+    try:
+        members, transitions = aggregate_transitions(batch)
+        async with training_lock:
+            await run_in_session(Session, apply_member_transitions, members, transitions)
+    except Exception:
+        traceback.print_exc()
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            training_retries.append((batch[:middle], 0))
+            training_retries.append((batch[middle:], 0))
+        elif attempts + 1 < TRAINING_ATTEMPTS:
+            training_retries.append((batch, attempts + 1))
+        else:
+            print(f"Dropped a message that failed to train {TRAINING_ATTEMPTS} times")
+        return False
+    chains_changed(members, transitions)
+    return True
+
+def aggregate_transitions(batch):
+    """Sum the transitions of many messages, per member"""
+    members = {}
+    transitions = {}
+    for member, message in batch:
+        key = (member.guild.id, member.id)
+        members[key] = member
+        transitions.setdefault(key, Counter()).update(get_transitions(message))
+    return members, transitions
+
+def apply_member_transitions(session, members, transitions):
+    for key, member in members.items():
+        apply_transitions(session, member, transitions[key])
+
+def chains_changed(members, transitions):
+    """Drop what was generated from the chains of members who were just trained on transitions"""
+    for key, member in members.items():
+        model_cache.invalidate(key)
+        message_pool.note_trained(key, sum(count for (word, _), count in transitions[key].items() if word == MESSAGE_START))
+
+async def channel_history(channel, after=None, before=None):
+    """Stream a channel's messages oldest first, after and before the given message ids"""
+    after = discord.Object(id=after) if after else None
+    before = discord.Object(id=before) if before else None
+    async for message in channel.history(limit=None, after=after, before=before, oldest_first=True):
+        yield message
+
+def get_checkpoint(session, channel_id):
+    return session.query(BackfillCheckpoint.last_message_id).filter_by(channel_id=channel_id).scalar()
+
+def apply_backfill_batch(session, channel_id, last_message_id, members, transitions):
+    """Train on a batch of history and move the channel's checkpoint past it in the same transaction"""
+    apply_member_transitions(session, members, transitions)
+    checkpoint = session.query(BackfillCheckpoint).filter_by(channel_id=channel_id).one_or_none() or\
+                 BackfillCheckpoint(channel_id=channel_id)
+    checkpoint.last_message_id = max(checkpoint.last_message_id or 0, last_message_id)
+    session.add(checkpoint)
+
+async def backfill(channel_id, history, end_message_id=None, batch_size=BACKFILL_BATCH_SIZE):
+    """Train on every message in history, an async iterable of messages oldest first such as channel_history.
+    Only one batch is held at a time, and each is committed along with a checkpoint, so an interrupted backfill can resume from it.
+    Once history runs out, the checkpoint moves up to end_message_id, the bound history was read up to.
+    Returns the number of messages trained on.
+    """
+    trained = 0
+    batch = []
+    read = 0
+    last_message_id = None
+    async def commit():
+        members, transitions = aggregate_transitions(batch)
+        async with training_lock:
+            await run_in_session(Session, apply_backfill_batch, channel_id, last_message_id, members, transitions)
+        chains_changed(members, transitions)
+
+    async for message in history:
+        read += 1
+        last_message_id = message.id
+        if not message.author.bot and getattr(message.author, 'guild', None) and message.content:
+            batch.append((message.author, message.content))
+        if read == batch_size:
+            await commit()
+            trained += len(batch)
+            batch = []
+            read = 0
+    if end_message_id:
+        last_message_id = end_message_id
+    if read or end_message_id:
+        await commit()
+        trained += len(batch)
+    return trained
+
+def prune_transitions(session, after_node_id, limit, min_count, top_k):
+    """Prune the transitions out of the limit words after after_node_id. Transitions seen fewer than min_count times, and all but
+    the top_k most common next words unless top_k is 0, are deleted and their counts added to the word's transition to the end of the message,
+    so the word's count still adds up. The start of each message is left alone, since it decides who gets simulated.
+    Returns the last node id looked at, or None once there are none left, the number of transitions deleted and the sim_member ids changed.
+    """
+    tuples = ProbabilityTuple.__table__
+    nodes = session.query(MarkovNode.id, MarkovNode.word, MarkovNode.sim_member_id)\
+                   .filter(MarkovNode.id > after_node_id).order_by(MarkovNode.id).limit(limit).all()
+    if not nodes:
+        return None, 0, set()
+    parents = {node_id: sim_member_id for node_id, word, sim_member_id in nodes if word != MESSAGE_START}
+    end_ids = dict(session.query(MarkovNode.sim_member_id, MarkovNode.id)
+                          .filter(MarkovNode.sim_member_id.in_(set(parents.values())), MarkovNode.word == MESSAGE_END))
+    successors = {}
+    for tuple_id, parent_node_id, node_id, count in session.query(ProbabilityTuple.id, ProbabilityTuple.parent_node_id, ProbabilityTuple.node_id, ProbabilityTuple.count)\
+                                                           .filter(ProbabilityTuple.parent_node_id.in_(parents)):
+        successors.setdefault(parent_node_id, []).append((tuple_id, node_id, count))
+
+    removed = []
+    end_updates = []
+    end_inserts = []
+    changed = set()
+    for parent_node_id, parent_successors in successors.items():
+        end_id = end_ids.get(parents[parent_node_id])
+        end_tuple = next((t for t in parent_successors if t[1] == end_id), None)
+        ranked = sorted((t for t in parent_successors if t is not end_tuple), key=lambda t: t[2], reverse=True)
+        pruned = [t for i, t in enumerate(ranked) if (top_k and i >= top_k) or t[2] < min_count]
+        if not pruned or end_id is None:
+            continue
+        removed.extend(tuple_id for tuple_id, _, _ in pruned)
+        folded = sum(count for _, _, count in pruned)
+        if end_tuple:
+            end_updates.append({'tuple': end_tuple[0], 'delta': folded})
+        else:
+            end_inserts.append({'parent_node_id': parent_node_id, 'node_id': end_id, 'count': folded})
+        changed.add(parents[parent_node_id])
+    if removed:
+        session.execute(tuples.delete().where(tuples.c.id.in_(removed)))
+    if end_updates:
+        session.execute(tuples.update().where(tuples.c.id == bindparam('tuple')).values(count=tuples.c.count + bindparam('delta')), end_updates)
+    if end_inserts:
+        session.execute(tuples.insert(), end_inserts)
+    return nodes[-1][0], len(removed), changed
+
+def remove_orphans(session, after_node_id, limit):
+    """Delete words among the limit after after_node_id that no transition leads to anymore, along with their transitions.
+    Returns the last node id looked at, or None once there are none left, the number of words and transitions deleted,
+    the bytes taken by the deleted words and the sim_member ids changed.
+    """
+    tuples = ProbabilityTuple.__table__
+    last_node_id = session.query(MarkovNode.id).filter(MarkovNode.id > after_node_id).order_by(MarkovNode.id).offset(limit-1).limit(1).scalar()
+    window = MarkovNode.id > after_node_id if last_node_id is None else MarkovNode.id.between(after_node_id+1, last_node_id)
+    orphans = session.query(MarkovNode.id, MarkovNode.word, MarkovNode.sim_member_id)\
+                     .filter(window, MarkovNode.word.notin_([MESSAGE_START, MESSAGE_END]),
+                             ~exists().where(ProbabilityTuple.node_id == MarkovNode.id)).all()
+    orphan_ids = [node_id for node_id, _, _ in orphans]
+    removed_tuples = 0
+    if orphan_ids:
+        removed_tuples = session.execute(tuples.delete().where(tuples.c.parent_node_id.in_(orphan_ids))).rowcount
+        session.execute(MarkovNode.__table__.delete().where(MarkovNode.__table__.c.id.in_(orphan_ids)))
+    return last_node_id, len(orphans), removed_tuples, sum(len(word.encode('utf-8')) for _, word, _ in orphans),\
+           {sim_member_id for _, _, sim_member_id in orphans}
+
+def get_member_keys(session, sim_member_ids):
+    return [(guild_id, member_id) for guild_id, member_id in
+            session.query(SimulatedMember.guild_id, SimulatedMember.member_id).filter(SimulatedMember.id.in_(sim_member_ids))]
+
+compaction_lock = asyncio.Lock()
+
+async def compact(min_count=PRUNE_MIN_COUNT, top_k=PRUNE_TOP_K, batch_size=COMPACTION_BATCH_SIZE):
+    """Prune every chain, then delete the words left unreachable, a batch at a time so no transaction holds its locks for long.
+    Returns a Counter of the transitions and words removed and an estimate of the bytes they took up.
+    """
+    async with compaction_lock:
+        removed = Counter()
+        changed = set()
+        after_node_id = 0
+        while after_node_id is not None:
+            async with training_lock:
+                after_node_id, removed_tuples, batch_changed = await run_in_session(Session, prune_transitions, after_node_id, batch_size, min_count, top_k)
+            removed['transitions'] += removed_tuples
+            changed |= batch_changed
+        after_node_id = 0
+        while after_node_id is not None:
+            async with training_lock:
+                after_node_id, removed_nodes, removed_tuples, word_bytes, batch_changed = await run_in_session(Session, remove_orphans, after_node_id, batch_size)
+            removed['words'] += removed_nodes
+            removed['transitions'] += removed_tuples
+            removed['bytes'] += word_bytes + removed_nodes * NODE_ROW_BYTES
+            changed |= batch_changed
+        removed['bytes'] += removed['transitions'] * TUPLE_ROW_BYTES
+        if changed:
+            for key in await run_in_session(Session, get_member_keys, changed):
+                model_cache.invalidate(key)
+                message_pool.discard(key)
+        return removed
+
+def format_compaction(removed):
+    return f"Removed {removed['transitions']} transitions and {removed['words']} words, about {removed['bytes'] / 1024:.0f} KB"
+
+def get_scheduled_channel_ids(session):
+    return [channel.channel_id for channel in session.query(Channel).all()]
+
+def unschedule_channels(session, channel_ids):
+    session.query(Channel).filter(Channel.channel_id.in_(channel_ids)).delete(synchronize_session=False)
+
+def get_transitions(message):
+    """Count the message's (word, next word) pairs, including the start and end markers"""
+    message_words = [word[:MAX_WORD_LENGTH] for word in f'{MESSAGE_START} {message} {MESSAGE_END}'.split()]
+    return Counter(zip(message_words, message_words[1:]))
+
+def apply_transitions(session, member, transitions):
+    """Add a Counter of (word, next word) transitions to the member's chain.
+    Uses the same handful of bulk statements however many transitions there are.
+    """
+    nodes = MarkovNode.__table__
+    tuples = ProbabilityTuple.__table__
     sim_member = SimulatedMember.get_or_create(member, session, create_args={'session': session})
-    message_words = f'{MESSAGE_START} {message} {MESSAGE_END}'.split()
-    for i in range(len(message_words)-1):
-        node = MarkovNode.get(message_words[i], sim_member, session)
-        node.increase_word_count(message_words[i+1], session)
-    session.commit()
-    session.close()
-
-def get_sim_members(guild, session):
-    simulated_member_ids = [sim_member.member_id for sim_member in SimulatedMember.get_guild_members(guild, session)]
-    result = [member for member in guild.members if member.id in simulated_member_ids]
-    return result
-
-def get_start_nodes(members, session):
-    start_nodes = []
-    for member in members:
-        sim_member = SimulatedMember.get(member, session)
-        start_nodes.append(MarkovNode.get(MESSAGE_START, sim_member, session))
-    return start_nodes
-
-def prevent_pings(word, guild, session):
+    session.flush()
+
+    words = {word for transition in transitions for word in transition}
+    def node_ids(words):
+        return dict(session.query(MarkovNode.word, MarkovNode.id).filter(MarkovNode.sim_member_id == sim_member.id, MarkovNode.word.in_(words)))
+    ids = node_ids(words)
+    new_words = words - ids.keys()
+    if new_words:
+        session.execute(nodes.insert(), [{'sim_member_id': sim_member.id, 'word': word, 'count': 0} for word in new_words])
+        ids.update(node_ids(new_words))
+
+    word_counts = Counter()
+    for (word, _), count in transitions.items():
+        word_counts[word] += count
+    session.execute(nodes.update().where(nodes.c.id == bindparam('node')).values(count=nodes.c.count + bindparam('delta')),
+                    [{'node': ids[word], 'delta': count} for word, count in word_counts.items()])
+
+    pairs = {(ids[word], ids[next_word]): count for (word, next_word), count in transitions.items()}
+    existing = {(parent_node_id, node_id): tuple_id for tuple_id, parent_node_id, node_id in
+                session.query(ProbabilityTuple.id, ProbabilityTuple.parent_node_id, ProbabilityTuple.node_id)
+                       .filter(ProbabilityTuple.parent_node_id.in_({parent for parent, _ in pairs}),
+                               ProbabilityTuple.node_id.in_({node for _, node in pairs}))}
+    updates = [{'tuple': existing[pair], 'delta': count} for pair, count in pairs.items() if pair in existing]
+    inserts = [{'parent_node_id': parent, 'node_id': node, 'count': count} for (parent, node), count in pairs.items() if (parent, node) not in existing]
+    if updates:
+        session.execute(tuples.update().where(tuples.c.id == bindparam('tuple')).values(count=tuples.c.count + bindparam('delta')), updates)
+    if inserts:
+        session.execute(tuples.insert(), inserts)
+
+def load_model(session, guild_id, member_id):
+    """Load a member's whole chain with a single query"""
+    rows = session.query(MarkovNode.id, MarkovNode.word, ProbabilityTuple.node_id, ProbabilityTuple.count)\
+                  .join(SimulatedMember, MarkovNode.sim_member_id == SimulatedMember.id)\
+                  .outerjoin(ProbabilityTuple, ProbabilityTuple.parent_node_id == MarkovNode.id)\
+                  .filter(SimulatedMember.guild_id == guild_id, SimulatedMember.member_id == member_id)\
+                  .order_by(MarkovNode.id).all()
+    return MarkovModel.from_rows(rows, MESSAGE_START, MESSAGE_END)
+
+def snapshot_path(key):
+    guild_id, member_id = key
+    return os.path.join(SNAPSHOT_DIR, f'{guild_id}_{member_id}.chain')
+
+def remove_snapshot(key):
+    if SNAPSHOT_DIR:
+        try:
+            os.remove(snapshot_path(key))
+        except FileNotFoundError:
+            pass
+
+class ModelCache:
+    """Members' Markov models, kept until they are trained on new messages or evicted.
+    Models missing from memory are mapped from their snapshot if there is one, and only loaded from the database otherwise.
+    """
+    def __init__(self, max_size):
+        self.models = LRUCache(max_size)
+        self.generations = {} #Bumped on invalidation, so a load that raced with training isn't cached
+
+    async def get(self, member):
+        key = (member.guild.id, member.id)
+        model = self.models.get(key)
+        if model is None:
+            model = self.read_snapshot(key)
+            if model is not None:
+                self.models.put(key, model)
+        if model is None:
+            model = await self.rebuild(key)
+        return model
+
+    async def rebuild(self, key):
+        """Load the model for (guild_id, member_id) from the database, caching it and saving its snapshot"""
+        generation = self.generations.get(key, 0)
+        model = await run_in_session(Session, load_model, *key)
+        if self.generations.get(key, 0) == generation:
+            self.models.put(key, model)
+            await self.write_snapshot(key, model, generation)
+        return model
+
+    def read_snapshot(self, key):
+        if not SNAPSHOT_DIR:
+            return None
+        try:
+            return load_snapshot(snapshot_path(key))
+        except (OSError, ValueError):
+            return None #Missing, or written by another snapshot version. It gets rebuilt from the database
+
+    async def write_snapshot(self, key, model, generation):
+        if not SNAPSHOT_DIR:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, save_snapshot, model, snapshot_path(key))
+        except OSError:
+            traceback.print_exc()
+            return
+        if self.generations.get(key, 0) != generation:
+            remove_snapshot(key) #Trained while it was being written
+
+    def invalidate(self, key):
+        self.models.pop(key)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        remove_snapshot(key)
+
+model_cache = ModelCache(MODEL_CACHE_SIZE)
+
+"""Started when the bot runs, by start_generation_pool"""
+generation_pool = None
+
+def start_generation_pool():
+    """Workers are spawned rather than forked, so they don't inherit the running bot's connections and threads.
+    A spawned worker imports this module again as __mp_main__, which is why the bot is only started under the __main__ guard below.
+    """
+    if not GENERATION_PROCESSES:
+        return None
+    if not SNAPSHOT_DIR:
+        print("SIMULATOR_GENERATION_PROCESSES needs SIMULATOR_SNAPSHOTS, generating in this process instead")
+        return None
+    pool = ProcessPoolExecutor(GENERATION_PROCESSES, mp_context=get_context('spawn'))
+    for _ in range(GENERATION_PROCESSES):
+        pool.submit(warm_up_worker)
+    return pool
+
+async def generate_words(member):
+    """Generate a message's words from member's chain, in the generation pool if there is one"""
+    global generation_pool
+    model = await model_cache.get(member)
+    if generation_pool:
+        key = (member.guild.id, member.id)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(generation_pool, generate_from_snapshot, snapshot_path(key), model_cache.generations.get(key, 0))
+        except (OSError, ValueError):
+            pass #The snapshot was removed by training since the model was loaded
+        except BrokenProcessPool:
+            traceback.print_exc()
+            print("The generation pool broke, generating in this process from now on")
+            generation_pool = None
+    return model.generate()
+
+def get_start_counts(session, guild_id):
+    """Map the id of each of the guild's simulated members to the number of messages they have sent, with one query"""
+    return dict(session.query(SimulatedMember.member_id, MarkovNode.count)
+                       .join(MarkovNode, MarkovNode.sim_member_id == SimulatedMember.id)
+                       .filter(SimulatedMember.guild_id == guild_id, MarkovNode.word == MESSAGE_START))
+
+def prevent_pings(word, guild):
     if word[0] == '<' and word[-1] == '>' and word[1] == '@':
         if word[2] == '!':
             member = get_user_from_id(int(word[3:-1]), guild)
@@ -166,22 +611,92 @@ def prevent_pings(word, guild, session):
     else:
         return word
 
-def create_message(member, guild, session):
-    words = [SimulatedMember.get(member, session).get_start_node(session)]
-    while words[-1].word != MESSAGE_END:
-        words.append(words[-1].choose_next_word(session))
-
-    message = ' '.join([prevent_pings(word.word, guild, session) for word in words[1:-1]])
+def format_message(member, words, guild):
+    message = ' '.join([prevent_pings(word, guild) for word in words])
     message = f'{member.nick or member.name}:\n    {message}'
     return message
 
-async def simulate(channel, session):
-    available_members = get_sim_members(channel.guild, session)
-    start_nodes = get_start_nodes(available_members, session)
-    for chosen_member in choices(available_members, weights=[node.count for node in start_nodes], k=randint(SIM_LENGTH_MIN, SIM_LENGTH_MAX)):
+class MessagePool:
+    """Messages generated ahead of time for each watched guild, as (member_id, words), so simulations don't wait on generation.
+    Pooled messages are taken in order, and were generated from members chosen in proportion to how many messages they've sent.
+    """
+    def __init__(self, size, max_drift):
+        self.size = size
+        self.max_drift = max_drift
+        self.pools = {}
+        self.start_counts = {} #Each guild's start counts as of its last refill
+        self.drift = Counter() #Messages trained on per (guild_id, member_id) since their pooled messages were thrown away
+
+    def watch(self, guild):
+        self.pools.setdefault(guild.id, deque())
+
+    def forget(self, guild_id):
+        self.pools.pop(guild_id, None)
+        self.start_counts.pop(guild_id, None)
+
+    async def refill(self, guild, target=None, refresh=False):
+        """Generate messages until the guild's pool holds target of them, the pool's size by default"""
+        pool = self.pools.setdefault(guild.id, deque())
+        target = self.size if target is None else target
+        if len(pool) >= target:
+            return
+        start_counts = self.start_counts.get(guild.id)
+        if not start_counts or refresh:
+            start_counts = await run_in_session(Session, get_start_counts, guild.id)
+            self.start_counts[guild.id] = start_counts
+        available_members = [(member, start_count) for member, start_count in
+                             ((guild.get_member(member_id), start_count) for member_id, start_count in start_counts.items()) if member]
+        if not available_members:
+            return
+        for member, _ in choices(available_members, weights=[start_count for _, start_count in available_members], k=target - len(pool)):
+            pool.append((member.id, await generate_words(member)))
+            await asyncio.sleep(0) #Let waiting events in between messages
+
+    async def take(self, guild):
+        """Pop the next message from a member still in the guild as (member, words), generating one if the pool has run dry.
+        Returns None if nobody in the guild can be simulated.
+        """
+        pool = self.pools.setdefault(guild.id, deque())
+        while True:
+            if not pool:
+                await self.refill(guild, 1)
+                if not pool:
+                    return None
+            member_id, words = pool.popleft()
+            member = guild.get_member(member_id)
+            if member:
+                return member, words
+
+    def note_trained(self, key, messages):
+        """Throw away a member's pooled messages once their chain has been trained on enough new messages to have drifted from them"""
+        guild_id, member_id = key
+        self.drift[key] += messages
+        start_count = self.start_counts.get(guild_id, {}).get(member_id)
+        if start_count is not None and self.drift[key] <= self.max_drift * start_count:
+            return
+        self.discard(key)
+
+    def discard(self, key):
+        guild_id, member_id = key
+        self.drift.pop(key, None)
+        pool = self.pools.get(guild_id)
+        if pool:
+            kept = [entry for entry in pool if entry[0] != member_id]
+            pool.clear() #In place, since a running refill may still be appending to this pool
+            pool.extend(kept)
+
+message_pool = MessagePool(POOL_SIZE, POOL_MAX_DRIFT)
+
+async def simulate(channel):
+    message_pool.watch(channel.guild)
+    for _ in range(randint(SIM_LENGTH_MIN, SIM_LENGTH_MAX)):
         async with channel.typing():
             start_time = time()
-            message = create_message(chosen_member, channel.guild, session)
+            taken = await message_pool.take(channel.guild)
+            if taken is None:
+                return
+            member, words = taken
+            message = format_message(member, words, channel.guild)
             try:
                 await asyncio.sleep(-(time() - start_time - randint(SIM_TIME_MIN, SIM_TIME_MAX)))
             except Exception:
@@ -193,40 +708,97 @@ async def simulate(channel, session):
 @ignore_bots
 async def on_message(message):
     content = message.content.lower()
-    increment_words(message.author, message.content)
+    if message.channel.id not in live_training_starts:
+        live_training_starts[message.channel.id] = message.id
+        await run_in_session(Session, record_live_training_start, message.channel.id, message.id)
+    if getattr(message.author, 'guild', None): #Direct messages come from users, who have no chain
+        await training_queue.put((message.author, message.content))
     await bot.process_commands(message)
 
 @bot.command(name='start', help="Begin a simulated conversation")
 async def start(ctx):
-    session = Session()
-    await simulate(ctx.channel, session)
-    session.commit()
-    session.close()
-
-@bot.command(name='schedule', help="Schedule a simulation to occur periodically in this channel. Use '-sim-schedule stop' to stop simulations in this channel")
-async def schedule(ctx, *args):
-    session = Session()
+    await simulate(ctx.channel)
+
+backfilling = set()
+
+@bot.command(name='backfill', help="Learn from this channel's message history. Picks up where the last backfill in this channel stopped")
+@commands.has_permissions(administrator=True)
+async def backfill_channel(ctx):
+    if ctx.channel.id in backfilling:
+        await ctx.channel.send("I'm already reading this channel's history")
+        return
+    backfilling.add(ctx.channel.id)
+    try:
+        await ctx.channel.send("Reading this channel's history...")
+        after = await run_in_session(Session, get_checkpoint, ctx.channel.id)
+        before = min(live_training_starts.get(ctx.channel.id, ctx.message.id), ctx.message.id)
+        trained = await backfill(ctx.channel.id, channel_history(ctx.channel, after, before), before)
+        await ctx.channel.send(f"Learned from {trained} messages")
+    finally:
+        backfilling.discard(ctx.channel.id)
+
+@bot.command(name='snapshot', help="Rebuild the saved chains of this guild's simulated members from the database", hidden=True)
+@commands.has_permissions(administrator=True)
+async def snapshot(ctx):
+    if not SNAPSHOT_DIR:
+        await ctx.channel.send("Snapshots are turned off. Set SIMULATOR_SNAPSHOTS to a directory to turn them on")
+        return
+    member_ids = await run_in_session(Session, get_start_counts, ctx.guild.id)
+    for member_id in member_ids:
+        await model_cache.rebuild((ctx.guild.id, member_id))
+    await ctx.channel.send(f"Rebuilt {len(member_ids)} snapshots")
+
+@bot.command(name='compact', help="Prune rare words and transitions from every simulated member's chain", hidden=True)
+@commands.has_permissions(administrator=True)
+async def compact_chains(ctx):
+    if not PRUNING:
+        await ctx.channel.send("Pruning is turned off. Set SIMULATOR_PRUNE_MIN_COUNT above 1 or SIMULATOR_PRUNE_TOP_K above 0 to turn it on")
+        return
+    if compaction_lock.locked():
+        await ctx.channel.send("I'm already compacting")
+        return
+    await ctx.channel.send("Compacting...")
+    await ctx.channel.send(format_compaction(await compact()))
+
+def schedule_channel(session, channel_id, args):
     if len(args) == 0:
-        if session.query(Channel).filter_by(channel_id=ctx.channel.id).one_or_none():
-            await ctx.channel.send("Simulations are already scheduled")
+        if session.query(Channel).filter_by(channel_id=channel_id).one_or_none():
+            return "Simulations are already scheduled"
         else:
-            await ctx.channel.send("Scheduling simulations in this channel!")
-            session.add(Channel(channel_id=ctx.channel.id))
-    elif args[0] == 'stop' and session.query(Channel).filter_by(channel_id=ctx.channel.id).one_or_none():
-        session.query(Channel).filter_by(channel_id=ctx.channel.id).delete()
-        await ctx.channel.send("Stopping simulations in this channel!")
+            session.add(Channel(channel_id=channel_id))
+            return "Scheduling simulations in this channel!"
+    elif args[0] == 'stop' and session.query(Channel).filter_by(channel_id=channel_id).one_or_none():
+        session.query(Channel).filter_by(channel_id=channel_id).delete()
+        return "Stopping simulations in this channel!"
     else:
-        await ctx.channel.send("I don't quite understand you. Did you mean '-sim-schedule stop'?")
+        return "I don't quite understand you. Did you mean '-sim-schedule stop'?"
 
-    session.commit()
-    session.close()
+@bot.command(name='schedule', help="Schedule a simulation to occur periodically in this channel. Use '-sim-schedule stop' to stop simulations in this channel")
+async def schedule(ctx, *args):
+    await ctx.channel.send(await run_in_session(Session, schedule_channel, ctx.channel.id, args))
 
 @bot.event
 async def on_command_error(ctx, exception):
     await ctx.channel.send("I'm sorry, I don't understand that command")
     raise exception
 
-bot.add_cog(ScheduledSimsCog())
-TOKEN = os.getenv('SIMULATOR_TOKEN')
-print("Starting up...")
-bot.run(TOKEN)
+if __name__ == '__main__':
+    set_up_storage()
+    with session_scope(Session) as session:
+        live_training_starts.update(get_live_training_starts(session))
+    generation_pool = start_generation_pool()
+    register_guild_index(bot)
+    bot.add_cog(ScheduledSimsCog())
+    bot.add_cog(TrainingCog())
+    bot.add_cog(MessagePoolCog())
+    if PRUNING:
+        bot.add_cog(CompactionCog())
+    TOKEN = os.getenv('SIMULATOR_TOKEN')
+    print("Starting up...")
+    bot.run(TOKEN)
+    members, transitions = aggregate_transitions([message for batch, _ in training_retries for message in batch] + take_queued())
+    with session_scope(Session) as session:
+        apply_member_transitions(session, members, transitions)
+    chains_changed(members, transitions)
+    if generation_pool:
+        generation_pool.shutdown()
@@ -1,41 +1,37 @@
+import asyncio
+import hashlib
 import time
 import os
+import traceback
+from collections import Counter
 from prettytable import PrettyTable
+from discord import NotFound
 from discord.ext import commands
 from discord.utils import find
-from contextlib import contextmanager
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, BigInteger, String, Boolean
+from sqlalchemy import Column, Index, Integer, BigInteger, String, Boolean
 
-from bot_utils import ignore_self, remove_punctuation, BaseMixin, typing
+from bot_utils import ignore_self, remove_punctuation, run_in_session, session_scope, BaseMixin, typing
 
 Base = declarative_base()
 engine = create_engine(os.getenv('INVENTORY_DB'))
 Session = sessionmaker(bind=engine)
 
 DELETE_AFTER_SECONDS = 60
-
-@contextmanager
-def session_scope():
-    """Provide a transactional scope around a series of operations."""
-    session = Session()
-    try:
-        yield session
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
+REDRAW_WINDOW = float(os.getenv('INVENTORY_REDRAW_WINDOW', 2)) #seconds between edits of the same table
 
 platinum_pieces = "PP"
 gold_pieces = "GP"
 silver_pieces = "SP"
 copper_pieces = "CP"
 
+"""What each denomination is worth in copper, largest first. The party's funds are kept as one copper balance and only split up for display"""
+COPPER_VALUES = [(platinum_pieces, 1000000), (gold_pieces, 10000), (silver_pieces, 100), (copper_pieces, 1)]
+COPPER_VALUE = dict(COPPER_VALUES)
+
 class GuildChannel(BaseMixin, Base):
     guild_id = Column(BigInteger)
     channel_id = Column(BigInteger)
@@ -46,12 +42,9 @@ class GuildChannel(BaseMixin, Base):
         self.guild_id = ctx.guild.id
         self.channel_id = ctx.channel.id
 
-    async def set_message_ids(self, ctx):
-        gold_message = await ctx.channel.send("gold")
-        self.gold_message_id = gold_message.id
-        items_message = await ctx.channel.send("items")
-        self.items_message_id = items_message.id
-        return
+    def set_message_ids(self, gold_message_id, items_message_id):
+        self.gold_message_id = gold_message_id
+        self.items_message_id = items_message_id
 
 class Item(BaseMixin, Base):
     guild_id = Column(BigInteger)
@@ -65,89 +58,76 @@ class Item(BaseMixin, Base):
         self.count = count
         self.is_gold = is_gold
 
+class PartyFunds(BaseMixin, Base):
+    __table_args__ = (Index('ix_partyfunds_guild_id', 'guild_id', unique=True),)
+    guild_id = Column(BigInteger)
+    copper = Column(BigInteger)
+
 Base.metadata.create_all(engine)
 
+def migrate_money_items(session):
+    """Fold the PP, GP, SP and CP item rows money used to be kept in into each guild's copper balance"""
+    balances = {}
+    money_items = session.query(Item).filter_by(is_gold=True).all()
+    for item in money_items:
+        balances[item.guild_id] = balances.get(item.guild_id, 0) + item.count * COPPER_VALUE[item.name]
+    funded = {guild_id for guild_id, in session.query(PartyFunds.guild_id).filter(PartyFunds.guild_id.in_(balances))}
+    session.add_all([PartyFunds(guild_id=guild_id, copper=copper) for guild_id, copper in balances.items() if guild_id not in funded])
+    for item in money_items:
+        session.delete(item)
+
+def guild_channel_ids(session):
+    return {gc.guild_id: [gc.channel_id, gc.gold_message_id, gc.items_message_id] for gc in session.query(GuildChannel).all()}
+
+"""Each guild's inventory channel and table message ids as [channel_id, gold_message_id, items_message_id], so tables can be edited without looking them up"""
+table_messages = {}
+GOLD_MESSAGE = 1
+ITEMS_MESSAGE = 2
+
+"""Hash of what each (guild_id, GOLD_MESSAGE or ITEMS_MESSAGE) message was last edited to, so unchanged tables aren't edited again"""
+table_hashes = {}
+table_edits = Counter()
+
+with session_scope(Session) as session:
+    migrate_money_items(session)
+    table_messages.update(guild_channel_ids(session))
+
 def add_initial_money(ctx, session):
-    pp = Item(ctx, platinum_pieces, 0, True)
-    gp = Item(ctx, gold_pieces, 0, True)
-    sp = Item(ctx, silver_pieces, 0, True)
-    cp = Item(ctx, copper_pieces, 0, True)
-
-    session.add_all([pp, gp, sp, cp])
-
-def add_platinum(session, ctx, amount):
-    pp = platinum_query(session, ctx)
-    pp.count += amount
-
-def add_gold(session, ctx, amount):
-    gp = gold_query(session, ctx)
-    gp.count += amount
-    if gp.count >= 100:
-        gp_count = gp.count
-        gp.count = gp_count % 100
-        add_platinum(session, ctx, (int)(gp_count/100))
-
-def add_silver(session, ctx, amount):
-    sp = silver_query(session, ctx)
-    sp.count += amount
-    if sp.count >= 100:
-        sp_count = sp.count
-        sp.count = sp_count % 100
-        add_gold(session, ctx, (int)(sp_count/100))
-
-def add_copper(session, ctx, amount):
-    cp = copper_query(session, ctx)
-    cp.count += amount
-    if cp.count >= 100:
-        cp_count = cp.count
-        cp.count = cp_count % 100
-        add_silver(session, ctx, (int)(cp_count/100))
-
-def subtract_platinum(session, ctx, amount):
-    pp = platinum_query(session, ctx)
-    if pp.count < amount:
+    if not session.query(PartyFunds.id).filter_by(guild_id=ctx.guild.id).scalar():
+        session.add(PartyFunds(guild_id=ctx.guild.id, copper=0))
+
+def add_money(session, ctx, copper):
+    funds = PartyFunds.__table__
+    result = session.execute(funds.update().where(funds.c.guild_id == ctx.guild.id).values(copper=funds.c.copper + copper))
+    if result.rowcount == 0:
+        raise ValueError("Use i!init before adding money")
+
+def subtract_money(session, ctx, copper):
+    funds = PartyFunds.__table__
+    result = session.execute(funds.update().where(funds.c.guild_id == ctx.guild.id, funds.c.copper >= copper)
+                                          .values(copper=funds.c.copper - copper))
+    if result.rowcount == 0:
         raise ValueError("You don't have enough money!")
-    pp.count -= amount
-
-def subtract_gold(session, ctx, amount):
-    gp = gold_query(session, ctx)
-    gp.count -= amount
-    times_added = 0
-    while gp.count < 0:
-        times_added += 1
-        gp.count += 100
-    subtract_platinum(session, ctx, times_added)
-
-def subtract_silver(session, ctx, amount):
-    sp = silver_query(session, ctx)
-    sp.count -= amount
-    times_added = 0
-    while sp.count < 0:
-        times_added += 1
-        sp.count += 100
-    subtract_gold(session, ctx, times_added)
-
-def subtract_copper(session, ctx, amount):
-    cp = copper_query(session, ctx)
-    cp.count -= amount
-    times_added = 0
-    while cp.count < 0:
-        times_added += 1
-        cp.count += 100
-    subtract_silver(session, ctx, times_added)
-
-def platinum_query(session, ctx):
-    return money_item_query(session, platinum_pieces, ctx)
-def gold_query(session, ctx):
-    return money_item_query(session, gold_pieces, ctx)
-def silver_query(session, ctx):
-    return money_item_query(session, silver_pieces, ctx)
-def copper_query(session, ctx):
-    return money_item_query(session, copper_pieces, ctx)
-
-def money_item_query(session, name, ctx):
-    return session.query(Item).filter_by(name=name, guild_id=ctx.guild.id, is_gold=True).one()
 
+def money_query(session, ctx):
+    return session.query(PartyFunds.copper).filter_by(guild_id=ctx.guild.id).scalar() or 0
+
+def split_copper(copper):
+    """Break a copper balance into [(denomination, amount)], using the largest coins possible"""
+    amounts = []
+    for name, value in COPPER_VALUES:
+        amount, copper = divmod(copper, value)
+        amounts.append((name, amount))
+    return amounts
+
+
+def buy_with_gold(session, ctx, name, amount, price):
+    subtract_money(session, ctx, price*amount*COPPER_VALUE[gold_pieces])
+    add_item(session, ctx, name, amount)
+
+def sell_for_gold(session, ctx, name, amount, price):
+    add_money(session, ctx, price*amount*COPPER_VALUE[gold_pieces])
+    subtract_item(session, ctx, name, amount)
 
 def add_item(session, ctx, name, amount=1):
     item = item_query(session, name, ctx)
@@ -177,37 +157,94 @@ def items_query(session, ctx):
 def guild_channel_query(session, ctx):
     return session.query(GuildChannel).filter_by(guild_id=ctx.guild.id).one()
 
-async def get_gold_msg(session, ctx):
-    msg_id = guild_channel_query(session, ctx).gold_message_id
-    return await get_msg(ctx, msg_id)
-async def get_items_msg(session, ctx):
-    msg_id = guild_channel_query(session, ctx).items_message_id
-    return await get_msg(ctx, msg_id)
-
-async def get_msg(ctx, msg_id):
-    return await ctx.fetch_message(msg_id)
-
-async def redraw_money_table(session, ctx):
-    pp = platinum_query(session, ctx)
-    gp = gold_query(session, ctx)
-    sp = silver_query(session, ctx)
-    cp = copper_query(session, ctx)
-
+def add_guild_channel(session, ctx, gc):
+    session.add(gc)
+    add_initial_money(ctx, session)
+
+def update_message_ids(session, ctx, channel_id, gold_message_id, items_message_id):
+    gc = guild_channel_query(session, ctx)
+    gc.channel_id = channel_id
+    gc.set_message_ids(gold_message_id, items_message_id)
+
+async def edit_table_message(ctx, which, content):
+    """Edit one of the guild's table messages through a partial message, so it doesn't have to be fetched first.
+    If the message has been deleted, a new one is sent in its place.
+    """
+    ids = table_messages.get(ctx.guild.id)
+    channel = bot.get_channel(ids[0]) if ids else None
+    if channel is None:
+        return
+    key = (ctx.guild.id, which)
+    content_hash = hashlib.sha1(content.encode('utf-8')).digest()
+    if table_hashes.get(key) == content_hash:
+        table_edits['skipped'] += 1
+        return
+    try:
+        await channel.get_partial_message(ids[which]).edit(content=content)
+    except NotFound:
+        message = await channel.send(content)
+        ids[which] = message.id
+        await run_in_session(Session, update_message_ids, ctx, *ids)
+    table_hashes[key] = content_hash
+    table_edits['made'] += 1
+
+def forget_table_hashes(guild_id):
+    """The guild's tables were sent again, so whatever they showed before doesn't count"""
+    for which in (GOLD_MESSAGE, ITEMS_MESSAGE):
+        table_hashes.pop((guild_id, which), None)
+
+async def send_table_messages(ctx):
+    gold_message = await ctx.channel.send("gold")
+    items_message = await ctx.channel.send("items")
+    return gold_message.id, items_message.id
+
+def render_money_table(session, ctx):
     table = PrettyTable(['Name', 'Amount'])
-    table.add_row([pp.name, pp.count])
-    table.add_row([gp.name, gp.count])
-    table.add_row([sp.name, sp.count])
-    table.add_row([cp.name, cp.count])
-    gold_message = await get_gold_msg(session, ctx)
-    await gold_message.edit(content=f'```\n{table}\n```')
-
-async def redraw_items_table(session, ctx):
+    for name, amount in split_copper(money_query(session, ctx)):
+        table.add_row([name, amount])
+    return f'```\n{table}\n```'
+
+def render_items_table(session, ctx):
     items = items_query(session, ctx)
     table = PrettyTable(['Name', 'Amount'])
     for item in items:
         table.add_row([item.name, item.count])
-    items_message = await get_items_msg(session, ctx)
-    await items_message.edit(content=f'```\n{table}\n```')
+    return f'```\n{table}\n```'
+
+async def redraw_money_table(ctx):
+    content = await run_in_session(Session, render_money_table, ctx)
+    await edit_table_message(ctx, GOLD_MESSAGE, content)
+
+async def redraw_items_table(ctx):
+    content = await run_in_session(Session, render_items_table, ctx)
+    await edit_table_message(ctx, ITEMS_MESSAGE, content)
+
+class RedrawScheduler:
+    """Redraws each guild's tables at most once per window. A table marked dirty right after a redraw waits out the window,
+    and everything marked in the meantime is covered by that one redraw, which renders whatever is current when it runs.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.last_redraw = {}
+
+    def mark_dirty(self, ctx, redraw_table):
+        key = (ctx.guild.id, redraw_table)
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.redraw(key, ctx, redraw_table))
+
+    async def redraw(self, key, ctx, redraw_table):
+        wait = self.last_redraw.get(key, -self.window) + self.window - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        del self.pending[key] #Anything marked dirty from here on might not be in this render, so gets a redraw of its own
+        self.last_redraw[key] = time.monotonic()
+        try:
+            await redraw_table(ctx)
+        except Exception:
+            traceback.print_exc()
+
+redraws = RedrawScheduler(REDRAW_WINDOW)
 
 async def remove_msg(ctx):
     await ctx.message.delete()
@@ -232,26 +269,28 @@ def print_commands():
 @typing
 @bot.command(name='init', help='Begin running the inventory_bot in this channel', usage='i!init')
 async def initialize_bot(ctx):
-    with session_scope() as session:
-        await ctx.channel.send(content=print_commands())
-        gc = GuildChannel(ctx)
-        await gc.set_message_ids(ctx)
-        session.add(gc)
-        add_initial_money(ctx, session)
-        await redraw_money_table(session, ctx)
-        await redraw_items_table(session, ctx)
+    await ctx.channel.send(content=print_commands())
+    gc = GuildChannel(ctx)
+    ids = [ctx.channel.id, *await send_table_messages(ctx)]
+    gc.set_message_ids(*ids[1:])
+    await run_in_session(Session, add_guild_channel, ctx, gc)
+    table_messages[ctx.guild.id] = ids
+    forget_table_hashes(ctx.guild.id)
+    redraws.mark_dirty(ctx, redraw_money_table)
+    redraws.mark_dirty(ctx, redraw_items_table)
 
     await remove_msg(ctx)
 
 @typing
 @bot.command(name='redraw', help='Redraw the item tables')
 async def redraw(ctx):
-    with session_scope() as session:
-        await ctx.channel.send(content=print_commands())
-        gc = guild_channel_query(session, ctx)
-        await gc.set_message_ids(ctx)
-        await redraw_money_table(session, ctx)
-        await redraw_items_table(session, ctx)
+    await ctx.channel.send(content=print_commands())
+    ids = [ctx.channel.id, *await send_table_messages(ctx)]
+    await run_in_session(Session, update_message_ids, ctx, *ids)
+    table_messages[ctx.guild.id] = ids
+    forget_table_hashes(ctx.guild.id)
+    redraws.mark_dirty(ctx, redraw_money_table)
+    redraws.mark_dirty(ctx, redraw_items_table)
     await remove_msg(ctx)
 
 @typing
@@ -261,9 +300,8 @@ async def add_platinum_to_pool(ctx, amount: int):
         await error_message(ctx, "The amount of platinum added must be > 0")
         return
 
-    with session_scope() as session:
-        add_platinum(session, ctx, amount)
-        await redraw_money_table(session, ctx)
+    await run_in_session(Session, add_money, ctx, amount*COPPER_VALUE[platinum_pieces])
+    redraws.mark_dirty(ctx, redraw_money_table)
     await remove_msg(ctx)
 
 @typing
@@ -273,9 +311,8 @@ async def add_gold_to_pool(ctx, amount: int):
         await error_message(ctx, "The amount of gold added must be > 0")
         return
 
-    with session_scope() as session:
-        add_gold(session, ctx, amount)
-        await redraw_money_table(session, ctx)
+    await run_in_session(Session, add_money, ctx, amount*COPPER_VALUE[gold_pieces])
+    redraws.mark_dirty(ctx, redraw_money_table)
     await remove_msg(ctx)
 
 @typing
@@ -285,9 +322,8 @@ async def add_silver_to_pool(ctx, amount: int):
         await error_message(ctx, "The amount of silver added must be > 0")
         return
 
-    with session_scope() as session:
-        add_silver(session, ctx, amount)
-        await redraw_money_table(session, ctx)
+    await run_in_session(Session, add_money, ctx, amount*COPPER_VALUE[silver_pieces])
+    redraws.mark_dirty(ctx, redraw_money_table)
     await remove_msg(ctx)
 
 @typing
@@ -297,9 +333,8 @@ async def add_copper_to_pool(ctx, amount: int):
         await error_message(ctx, "The amount of copper added must be > 0")
         return
 
-    with session_scope() as session:
-        add_copper(session, ctx, amount)
-        await redraw_money_table(session, ctx)
+    await run_in_session(Session, add_money, ctx, amount*COPPER_VALUE[copper_pieces])
+    redraws.mark_dirty(ctx, redraw_money_table)
     await remove_msg(ctx)
 
 @typing
@@ -310,9 +345,8 @@ async def remove_platinum_from_pool(ctx, amount: int):
         return
 
     try:
-        with session_scope() as session:
-            subtract_platinum(session, ctx, amount)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, subtract_money, ctx, amount*COPPER_VALUE[platinum_pieces])
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(e)
     await remove_msg(ctx)
@@ -325,9 +359,8 @@ async def remove_gold_from_pool(ctx, amount: int):
         return
 
     try:
-        with session_scope() as session:
-            subtract_gold(session, ctx, amount)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, subtract_money, ctx, amount*COPPER_VALUE[gold_pieces])
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(e)
     await remove_msg(ctx)
@@ -340,9 +373,8 @@ async def remove_silver_from_pool(ctx, amount: int):
         return
 
     try:
-        with session_scope() as session:
-            subtract_silver(session, ctx, amount)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, subtract_money, ctx, amount*COPPER_VALUE[silver_pieces])
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(e)
     await remove_msg(ctx)
@@ -355,9 +387,8 @@ async def remove_copper_from_pool(ctx, amount: int):
         return
 
     try:
-        with session_scope() as session:
-            subtract_copper(session, ctx, amount)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, subtract_money, ctx, amount*COPPER_VALUE[copper_pieces])
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(e)
     await remove_msg(ctx)
@@ -366,9 +397,8 @@ async def remove_copper_from_pool(ctx, amount: int):
 @bot.command(name='additem', help='Add a new item to the party inventory', aliases=['acquire', 'newitem', 'add', 'item'])
 async def add_item_to_pool(ctx, *, name: str):
     name = name.lower()
-    with session_scope() as session:
-        add_item(session, ctx, name)
-        await redraw_items_table(session, ctx)
+    await run_in_session(Session, add_item, ctx, name)
+    redraws.mark_dirty(ctx, redraw_items_table)
     await remove_msg(ctx)
 
 @typing
@@ -379,9 +409,8 @@ async def add_items_to_pool(ctx, amount: int, *, name: str):
         await error_message(ctx, "The number of items added must be > 0")
         return
 
-    with session_scope() as session:
-        add_item(session, ctx, name, amount)
-        await redraw_items_table(session, ctx)
+    await run_in_session(Session, add_item, ctx, name, amount)
+    redraws.mark_dirty(ctx, redraw_items_table)
     await remove_msg(ctx)
 
 @typing
@@ -389,9 +418,8 @@ async def add_items_to_pool(ctx, amount: int, *, name: str):
 async def remove_item_from_pool(ctx, *, name: str):
     name = name.lower()
     try:
-        with session_scope() as session:
-            subtract_item(session, ctx, name)
-            await redraw_items_table(session, ctx)
+        await run_in_session(Session, subtract_item, ctx, name)
+        redraws.mark_dirty(ctx, redraw_items_table)
     except ValueError as e:
         await error_message(e)
     await remove_msg(ctx)
@@ -404,9 +432,8 @@ async def remove_items_from_pool(ctx, amount: int, *, name: str):
         await error_message(ctx, "The number of items removed must be > 0")
         return
     try:
-        with session_scope() as session:
-            subtract_item(session, ctx, name, amount)
-            await redraw_items_table(session, ctx)
+        await run_in_session(Session, subtract_item, ctx, name, amount)
+        redraws.mark_dirty(ctx, redraw_items_table)
     except ValueError as e:
         await error_message(e)
     await remove_msg(ctx)
@@ -419,11 +446,9 @@ async def buy_item(ctx, price: int, *, name: str):
         await error_message(ctx, "The price of the item must be > 0")
         return
     try:
-        with session_scope() as session:
-            subtract_gold(session, ctx, price)
-            add_item(session, ctx, name)
-            await redraw_items_table(session, ctx)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, buy_with_gold, ctx, name, 1, price)
+        redraws.mark_dirty(ctx, redraw_items_table)
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(ctx, e)
     await remove_msg(ctx)
@@ -439,11 +464,9 @@ async def buy_items(ctx, amount: int, price: int, *, name: str):
         await error_message(ctx, "The number of items purchased must be > 0")
         return
     try:
-        with session_scope() as session:
-            subtract_gold(session, ctx, price*amount)
-            add_item(session, ctx, name, amount)
-            await redraw_items_table(session, ctx)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, buy_with_gold, ctx, name, amount, price)
+        redraws.mark_dirty(ctx, redraw_items_table)
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(ctx, e)
     await remove_msg(ctx)
@@ -456,11 +479,9 @@ async def sell_item(ctx, price: int, *, name: str):
         await error_message(ctx, "The price of the item must be > 0")
         return
     try:
-        with session_scope() as session:
-            add_gold(session, ctx, price)
-            subtract_item(session, ctx, name)
-            await redraw_items_table(session, ctx)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, sell_for_gold, ctx, name, 1, price)
+        redraws.mark_dirty(ctx, redraw_items_table)
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(ctx, e)
     await remove_msg(ctx)
@@ -476,15 +497,20 @@ async def sell_items(ctx, amount: int, price: int, *, name: str):
         await error_message(ctx, "The number of items sold must be > 0")
         return
     try:
-        with session_scope() as session:
-            add_gold(session, ctx, price*amount)
-            subtract_item(session, ctx, name, amount)
-            await redraw_items_table(session, ctx)
-            await redraw_money_table(session, ctx)
+        await run_in_session(Session, sell_for_gold, ctx, name, amount, price)
+        redraws.mark_dirty(ctx, redraw_items_table)
+        redraws.mark_dirty(ctx, redraw_money_table)
     except ValueError as e:
         await error_message(ctx, e)
     await remove_msg(ctx)
 
+@bot.command(name='edits', help='See how many table edits were skipped because the table had not changed', hidden=True)
+async def edit_stats(ctx):
+    made, skipped = table_edits['made'], table_edits['skipped']
+    await ctx.channel.send(content=f'Edited tables {made} times and skipped {skipped} edits ({skipped / max(made + skipped, 1):.1%}) that would not have changed anything',
+                           delete_after=DELETE_AFTER_SECONDS)
+    await remove_msg(ctx)
+
 @bot.event
 async def on_command_error(ctx, exception):
     await error_message(ctx, "I'm sorry, I don't understand that command")
@@ -9,7 +9,7 @@ from sqlalchemy import Column, Integer, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from bot_utils import BaseMixin
+from bot_utils import BaseMixin, run_in_session
 
 POLL_FREQUENCY = 60
 bot = commands.Bot(command_prefix='-ip-', description="I only exist to notify you when my ip address changes\nFor suggestions and bug reports, create an issue on my github: https://github.com/caydenreynolds/Discord-bots")
@@ -33,47 +33,49 @@ class PollIPCog(commands.Cog):
     async def poll_ip(self):
         try:
             await bot.wait_until_ready()
-            session = Session()
             global ip_addr
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             s.connect(("8.8.8.8", 80))
             if s.getsockname()[0] != ip_addr:
                 ip_addr = s.getsockname()[0]
                 channels = []
-                for channel in session.query(Channel).all():
-                    c = bot.get_channel(channel.channel_id)
+                missing = []
+                for channel_id in await run_in_session(Session, get_channel_ids):
+                    c = bot.get_channel(channel_id)
                     if c:
                         channels.append(c)
                     else:
-                        session.delete(channel)
+                        missing.append(channel_id)
+                if missing:
+                    await run_in_session(Session, remove_channels, missing)
                 message = f"My new IP addr is {ip_addr}"
                 for channel in channels:
                     await channel.send(message)
         except Exception:
             traceback.print_exc()
-            session.rollback()
-        else:
-            session.commit()
-        finally:
-            session.close()
 
-@bot.command(name='notify', help="Begin notifications in this channel")
-async def schedule(ctx, *args):
-    session = Session()
+def get_channel_ids(session):
+    return [channel.channel_id for channel in session.query(Channel).all()]
+
+def remove_channels(session, channel_ids):
+    session.query(Channel).filter(Channel.channel_id.in_(channel_ids)).delete(synchronize_session=False)
+
+def notify_channel(session, channel_id, args):
     if len(args) == 0:
-        if session.query(Channel).filter_by(channel_id=ctx.channel.id).one_or_none():
-            await ctx.channel.send("Notifications are already scheduled")
+        if session.query(Channel).filter_by(channel_id=channel_id).one_or_none():
+            return "Notifications are already scheduled"
         else:
-            await ctx.channel.send("Scheduling notifications in this channel!")
-            session.add(Channel(channel_id=ctx.channel.id))
-    elif args[0] == 'stop' and session.query(Channel).filter_by(channel_id=ctx.channel.id).one_or_none():
-        session.query(Channel).filter_by(channel_id=ctx.channel.id).delete()
-        await ctx.channel.send("Stopping notifications in this channel!")
+            session.add(Channel(channel_id=channel_id))
+            return "Scheduling notifications in this channel!"
+    elif args[0] == 'stop' and session.query(Channel).filter_by(channel_id=channel_id).one_or_none():
+        session.query(Channel).filter_by(channel_id=channel_id).delete()
+        return "Stopping notifications in this channel!"
     else:
-        await ctx.channel.send("I don't quite understand you. Did you mean '-ip-notify stop'?")
+        return "I don't quite understand you. Did you mean '-ip-notify stop'?"
 
-    session.commit()
-    session.close()
+@bot.command(name='notify', help="Begin notifications in this channel")
+async def schedule(ctx, *args):
+    await ctx.channel.send(await run_in_session(Session, notify_channel, ctx.channel.id, args))
 
 bot.add_cog(PollIPCog())
 TOKEN = os.getenv('IP_TOKEN')
@@ -0,0 +1,155 @@
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+from random import randint
+
+"""Snapshot files are a header followed by 8-byte aligned sections: word start offsets, the utf-8 word blob, offsets, targets and cumulative.
+Everything is in native byte order, so a snapshot from a machine with the other byte order fails the version check and gets rebuilt.
+"""
+SNAPSHOT_MAGIC = b'MKVS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('=4sIIIIIQ') #magic, version, words, edges, start, end, blob size
+
+def cumulative_counts(counts):
+    cumulative = array('Q')
+    total = 0
+    for count in counts:
+        total += count
+        cumulative.append(total)
+    return cumulative
+
+def weighted_index(cumulative, begin=0, end=None):
+    """Pick an index in [begin, end) with probability proportional to its count, given running totals of the counts starting at begin"""
+    if end is None:
+        end = len(cumulative)
+    return bisect_right(cumulative, randint(0, cumulative[end-1] - 1), begin, end)
+
+class WordTable:
+    """Words stored as one utf-8 blob, decoded as they are looked up. Word i is blob[starts[i]:starts[i+1]]"""
+    __slots__ = ('starts', 'blob')
+
+    def __init__(self, starts, blob):
+        self.starts = starts
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.starts[i]:self.starts[i+1]], 'utf-8')
+
+class MarkovModel:
+    """A Markov chain stored in integer-indexed arrays, so messages can be generated without the database.
+    Word i's successors are targets[offsets[i]:offsets[i+1]], and cumulative holds the running total
+    of their transition counts, restarting at each word.
+    """
+    __slots__ = ('words', 'offsets', 'targets', 'cumulative', 'start', 'end')
+
+    def __init__(self, words, offsets, targets, cumulative, start, end):
+        self.words = words
+        self.offsets = offsets
+        self.targets = targets
+        self.cumulative = cumulative
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_rows(cls, rows, start_word, end_word):
+        """Build a model from (node_id, word, next_node_id, count) rows, sorted by node_id.
+        Nodes without successors appear once with next_node_id None.
+        """
+        words = []
+        indexes = {}
+        edges = []
+        for node_id, word, next_node_id, count in rows:
+            if node_id not in indexes:
+                indexes[node_id] = len(words)
+                words.append(word)
+                edges.append([])
+            if next_node_id is not None:
+                edges[-1].append((next_node_id, count))
+
+        offsets = array('I', [0])
+        targets = array('I')
+        cumulative = array('Q')
+        for successors in edges:
+            targets.extend(indexes[next_node_id] for next_node_id, _ in successors)
+            cumulative.extend(cumulative_counts(count for _, count in successors))
+            offsets.append(len(targets))
+        return cls(words, offsets, targets, cumulative, words.index(start_word), words.index(end_word))
+
+    def next_word(self, node):
+        return self.targets[weighted_index(self.cumulative, self.offsets[node], self.offsets[node+1])]
+
+    def generate(self):
+        """The words of a new message, without the start and end markers"""
+        words = []
+        node = self.next_word(self.start)
+        while node != self.end:
+            words.append(self.words[node])
+            node = self.next_word(node)
+        return words
+
+def save_snapshot(model, path):
+    """Write the model to path, replacing any existing snapshot only once the new one is complete"""
+    encoded = [model.words[i].encode('utf-8') for i in range(len(model.words))]
+    starts = array('I', [0])
+    for word in encoded:
+        starts.append(starts[-1] + len(word))
+    blob = b''.join(encoded)
+    sections = [starts.tobytes(), blob, array('I', model.offsets).tobytes(), array('I', model.targets).tobytes(), array('Q', model.cumulative).tobytes()]
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(encoded), len(model.targets), model.start, model.end, len(blob))
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            for section in sections:
+                f.write(section)
+                f.write(bytes(-len(section) % 8))
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def load_snapshot(path):
+    """Memory-map a snapshot written by save_snapshot. The arrays are views into the file, so nothing is copied or parsed up front"""
+    with open(path, 'rb') as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, word_count, edge_count, start, end, blob_size = SNAPSHOT_HEADER.unpack_from(view)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f'{path} is not a version {SNAPSHOT_VERSION} snapshot')
+
+    position = SNAPSHOT_HEADER.size
+    def section(size, format=None):
+        nonlocal position
+        part = view[position:position+size]
+        position += size + -size % 8
+        return part.cast(format) if format else part
+    starts = section(4 * (word_count+1), 'I')
+    blob = section(blob_size)
+    offsets = section(4 * (word_count+1), 'I')
+    targets = section(4 * edge_count, 'I')
+    cumulative = section(8 * edge_count, 'Q')
+    return MarkovModel(WordTable(starts, blob), offsets, targets, cumulative, start, end)
+
+"""Models mapped by this generation worker process, by snapshot path, along with the version they were mapped at"""
+worker_models = {}
+WORKER_MODEL_LIMIT = 1000
+
+def warm_up_worker():
+    """Run once per worker when the pool starts, so the first real request doesn't wait for the process to start"""
+    return os.getpid()
+
+def generate_from_snapshot(path, version):
+    """Generate a message's words in a worker process from the snapshot at path, mapping it again only when version has changed"""
+    loaded = worker_models.pop(path, None)
+    if loaded is None or loaded[0] != version:
+        loaded = (version, load_snapshot(path))
+    worker_models[path] = loaded
+    while len(worker_models) > WORKER_MODEL_LIMIT:
+        del worker_models[next(iter(worker_models))]
+    return loaded[1].generate()
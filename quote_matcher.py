@@ -0,0 +1,158 @@
+import os
+import re
+import string
+from array import array
+from bisect import bisect_right
+from collections import Counter, namedtuple
+
+DEFAULT_MIN_WORDS = 3
+
+"""A quoted span: words [start, start+length) of line number `line` in `corpus`"""
+Quote = namedtuple('Quote', ['corpus', 'line', 'start', 'length'])
+
+def split_lines(script):
+    return [line for line in re.split(r'\.|\?|\!', script) if len(line) > 2] #Get all sentences, with short ones removed
+
+class ScriptLine:
+    """A script line with its punctuation-free words, and offsets[i] giving the index in text of normalized character i"""
+    __slots__ = ('text', 'words', 'word_starts', 'offsets')
+
+    def __init__(self, text):
+        self.text = text
+        self.offsets = [index for index, char in enumerate(text) if char not in string.punctuation]
+        normalized = ''.join(text[index] for index in self.offsets)
+        matches = list(re.finditer(r'\S+', normalized))
+        self.words = [match.group() for match in matches]
+        self.word_starts = [match.start() for match in matches]
+
+    def bold(self, start, length):
+        """Bold words [start, start+length) of the line, along with any punctuation between them"""
+        last = start + length - 1
+        begin = self.offsets[self.word_starts[start]]
+        end = self.offsets[self.word_starts[last] + len(self.words[last]) - 1] + 1
+        return f'{self.text[:begin]}**{self.text[begin:end]}**{self.text[end:]}'
+
+class Corpus:
+    def __init__(self, name, lines, min_words=DEFAULT_MIN_WORDS):
+        self.name = name
+        self.lines = [ScriptLine(line) for line in lines]
+        self.min_words = min_words
+
+    @classmethod
+    def from_file(cls, path, min_words=DEFAULT_MIN_WORDS):
+        with open(path, encoding='utf-8') as f:
+            script = f.read()
+        return cls(os.path.splitext(os.path.basename(path))[0], split_lines(script), min_words)
+
+def load_corpora(spec, base_dir='.'):
+    """Load corpora from a comma separated list of 'path' or 'path=min_words' entries"""
+    corpora = []
+    for entry in spec.split(','):
+        path, _, min_words = entry.strip().partition('=')
+        corpora.append(Corpus.from_file(os.path.join(base_dir, path), int(min_words or DEFAULT_MIN_WORDS)))
+    return corpora
+
+class SuffixAutomaton:
+    """Word-level suffix automaton of a corpus, with its lines joined by a separator no message word can match.
+    Every run of words in a line is a path from the root, and there are at most two states per word, however long the lines are.
+    State s accepts the runs of length (length[link[s]], length[s]] that end at the same places, the first of them at first_end[s].
+    """
+    def __init__(self, lines):
+        self.next = [{}]
+        self.link = array('i', [-1])
+        self.length = array('i', [0])
+        self.first_end = array('i', [-1])
+        self.line_starts = array('i') #Position of each line's first word
+        last = 0
+        position = 0
+        for line in lines:
+            self.line_starts.append(position)
+            for word in line.words + [None]:
+                last = self._extend(last, word, position)
+                position += 1
+
+    def _add_state(self, length, first_end):
+        self.next.append({})
+        self.link.append(-1)
+        self.length.append(length)
+        self.first_end.append(first_end)
+        return len(self.next) - 1
+
+    def _extend(self, last, word, position):
+        current = self._add_state(self.length[last] + 1, position)
+        state = last
+        while state != -1 and word not in self.next[state]:
+            self.next[state][word] = current
+            state = self.link[state]
+        if state == -1:
+            self.link[current] = 0
+            return current
+        target = self.next[state][word]
+        if self.length[state] + 1 == self.length[target]:
+            self.link[current] = target
+            return current
+        clone = self._add_state(self.length[state] + 1, self.first_end[target])
+        self.next[clone] = dict(self.next[target])
+        self.link[clone] = self.link[target]
+        while state != -1 and self.next[state].get(word) == target:
+            self.next[state][word] = clone
+            state = self.link[state]
+        self.link[target] = self.link[current] = clone
+        return current
+
+    def step(self, state, length, word):
+        """Follow word from the state matching the last length words read, falling back to shorter matches until one can be extended"""
+        while state and word not in self.next[state]:
+            state = self.link[state]
+            length = self.length[state]
+        child = self.next[state].get(word)
+        if child is None:
+            return 0, 0
+        return child, length + 1
+
+    def locate(self, state, length):
+        """The (line, start) of the first occurrence of the state's run of length words"""
+        start = self.first_end[state] - length + 1
+        line = bisect_right(self.line_starts, start) - 1
+        return line, start - self.line_starts[line]
+
+class QuoteAutomaton:
+    """One suffix automaton per corpus, all stepped through the message together.
+    After reading a word, each corpus' state matches the longest message suffix that corpus quotes.
+    """
+    def __init__(self, corpora):
+        self.corpora = corpora
+        self.automata = [SuffixAutomaton(corpus.lines) for corpus in corpora]
+        self.states = sum(len(automaton.next) for automaton in self.automata)
+        self.vocabulary = frozenset(word for corpus in corpora for line in corpus.lines for word in line.words)
+        self.min_words = min(corpus.min_words for corpus in corpora)
+        self.stats = Counter()
+
+    def could_quote(self, message_words):
+        """Whether the message has a run of min_words consecutive words that all appear in some corpus"""
+        run = 0
+        for word in message_words:
+            run = run + 1 if word in self.vocabulary else 0
+            if run >= self.min_words:
+                return True
+        return False
+
+    def find(self, message_words):
+        """Return the longest quote found in a single pass over the message, or None.
+        Ties go to the quote that ends first in the message.
+        """
+        self.stats['messages'] += 1
+        if not self.could_quote(message_words):
+            self.stats['skipped'] += 1
+            return None
+        best = None
+        matches = [(0, 0)] * len(self.automata)
+        for word in message_words:
+            for corpus_index, automaton in enumerate(self.automata):
+                state, length = matches[corpus_index] = automaton.step(*matches[corpus_index], word)
+                if length >= self.corpora[corpus_index].min_words and (best is None or length > best[2]):
+                    best = (corpus_index, state, length)
+        if best is None:
+            return None
+        corpus_index, state, length = best
+        return Quote(corpus_index, *self.automata[corpus_index].locate(state, length), length)